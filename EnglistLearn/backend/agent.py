@@ -40,7 +40,6 @@ class EnglishLearningAgent:
     def update_context(self, student_response):
         """根据学生回答更新上下文"""
         # 这里可以添加逻辑来分析学生水平
-        # 简化实现：根据回答长度和复杂度调整
-        if len(student_response) > 50:
-            self.context["student_level"] = "intermediate"
-        return self.context
\ No newline at end of file
+        # 简化实现：根据回答长度调整，已是中级时跳过长度计算
+        if self.context["student_level"] != "intermediate" and len(student_response) > 50:
+            self.context["student_level"] = "intermediate"
\ No newline at end of file
@@ -18,4 +18,10 @@ class Config:
     
     # 会话配置
     SESSION_TIMEOUT = 3600  # 1小时
-    MAX_HISTORY_MESSAGES = 50
\ No newline at end of file
+    MAX_HISTORY_MESSAGES = 50
+    
+    # 流式输出合并配置：首个token立即发送，之后每次发送的批量按增长因子扩大
+    DEFAULT_BATCH_SIZE = int(os.getenv("DEFAULT_BATCH_SIZE", "8"))
+    DEFAULT_MIN_BATCH_SIZE = int(os.getenv("DEFAULT_MIN_BATCH_SIZE", "1"))
+    DEFAULT_BATCH_SIZE_GROWTH_FACTOR = float(os.getenv("DEFAULT_BATCH_SIZE_GROWTH_FACTOR", "3"))
+    STREAM_FLUSH_INTERVAL = 0.03  # 最长合并等待时间（秒）
\ No newline at end of file
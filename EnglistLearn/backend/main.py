@@ -1,12 +1,12 @@
 """英语学习应用主程序"""
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
 from typing import AsyncGenerator, Optional
 import json
-import uuid
+import secrets
 import time
 import logging
 
@@ -14,9 +14,13 @@ from google.adk.runners import InMemoryRunner
 from google.adk.sessions.in_memory_session_service import InMemorySessionService
 from google.genai import types
 from google.adk.agents.run_config import RunConfig, StreamingMode
+from sse_starlette.sse import EventSourceResponse
 
-from utils import print_exception_stack
+from utils import json_dumps, json_loads
 from agent import EnglishLearningAgent
+from config import Config
+from openai_client import close_shared_clients as close_openai_clients
+from qianwen import close_shared_clients as close_qwen_clients
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -51,32 +55,89 @@ runner = InMemoryRunner(
 # 会话服务
 # await runner.session_service = InMemorySessionService()
 
-class SSEGenerator:
-    """SSE事件生成器"""
-    def __init__(self):
-        self.event_id = 0
-    
-    def generate_sse_event(self, data: dict, event_type: str = "message") -> str:
-        """生成SSE格式的事件"""
-        self.event_id += 1
-        event = {
-            "id": self.event_id,
-            "type": event_type,
-            "data": data,
-            "timestamp": time.time()
-        }
-        return f"id: {self.event_id}\nevent: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+# 运行配置在请求间不变，模块加载时创建一次
+_STREAM_RUN_CONFIG = RunConfig(
+    streaming_mode=StreamingMode.SSE,
+    response_modalities=["TEXT"],
+    max_llm_calls=10,
+)
+_DIRECT_RUN_CONFIG = RunConfig(
+    response_modalities=["TEXT"],
+    max_llm_calls=10,
+)
+
+@app.on_event("shutdown")
+async def shutdown():
+    """应用退出时释放共享的 HTTP 连接池"""
+    await close_openai_clients()
+    await close_qwen_clients()
+
+def _sse_event(data: dict, event_type: str, event_id: int = 0) -> bytes:
+    """构建低频SSE事件（complete/error），直接生成字节串，EventSourceResponse 原样发送"""
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (
+        event_id, event_type.encode("utf-8"), json_dumps(data)
+    )
 
-sse_generator = SSEGenerator()
+# 固定内容的错误事件在模块加载时预先序列化为完整的SSE帧
+_ERROR_FRAME_PREFIX = b'id: 0\nevent: error\ndata: {"error":'
+_EMPTY_MSG_FRAME = _ERROR_FRAME_PREFIX + json_dumps("请输入消息") + b"}\n\n"
+_BAD_REQUEST_FRAME = _ERROR_FRAME_PREFIX + json_dumps("请求格式错误") + b"}\n\n"
+
+def _build_chunk_frame(session_id: str) -> tuple[bytes, bytes]:
+    """预先构建流式文本块SSE帧中不变的前缀和后缀，每个token只需序列化文本本身"""
+    prefix = (
+        b'\nevent: message\ndata: {"session_id":%s,"event_type":"chunk","text":'
+        % json_dumps(session_id)
+    )
+    return prefix, b"}\n\n"
+
+def _complete_event(text: str, full_response: str, session_id: str, event_id: int) -> bytes:
+    """构建流结束时的complete事件"""
+    data = {
+        "text": text,
+        "session_id": session_id,
+        "event_type": "complete",
+        "full_response": full_response
+    }
+    return _sse_event(data, "complete", event_id)
+
+# Agent 事件队列的容量，生产者超前过多时等待消费
+_EVENT_QUEUE_SIZE = 64
+# 事件流正常结束的标记
+_STREAM_END = object()
+
+async def _pump_events(run_iter, queue: asyncio.Queue):
+    """在单个任务中消费 Agent 事件流并放入队列，异常同样放入队列交给消费方抛出"""
+    try:
+        async for event in run_iter:
+            await queue.put(event)
+    except Exception as e:
+        await queue.put(e)
+        return
+    finally:
+        await run_iter.aclose()
+    await queue.put(_STREAM_END)
 
-async def agent_stream_generator(user_input: str, session_id: str, user_id: str) -> AsyncGenerator:
-    """生成Agent响应的流式数据"""
+async def agent_stream_generator(
+    user_input: str,
+    session_id: str,
+    user_id: str,
+    session_task: Optional[asyncio.Task] = None
+) -> AsyncGenerator:
+    """生成Agent响应的流式数据，session_task 为调用方已启动的会话创建任务"""
+    event_id = 0
     try:
         logger.info(f"处理用户消息: {user_input[:50]}...")
         logger.info(f"会话ID: {session_id}, 用户ID: {user_id}")
         
         # 确保会话存在
-        if session_id.startswith("local_"):
+        if session_task is not None:
+            # 会话创建与响应建立并行进行，这里等待其完成
+            session = await session_task
+            session_id = session.id
+            user_id = session.user_id
+            logger.info(f"创建新会话: {session_id}")
+        elif session_id.startswith("local_"):
             # 如果是前端生成的本地会话ID，创建新会话
             session = await runner.session_service.create_session(
                 app_name="FunEnglishLearning",
@@ -109,96 +170,152 @@ async def agent_stream_generator(user_input: str, session_id: str, user_id: str)
             user_id=user_id,
             session_id=session_id,
             new_message=content,
-            run_config=RunConfig(
-                streaming_mode=StreamingMode.SSE,
-                response_modalities=["TEXT"],
-                max_llm_calls=10,
-            )
+            run_config=_STREAM_RUN_CONFIG
         )
         
-        full_response = ""
+        chunk_prefix, chunk_suffix = _build_chunk_frame(session_id)
+        # 用列表收集文本块，结束时一次性拼接，避免逐token字符串拼接
+        full_parts: list[str] = []
+        completed_sent = False
+        # 合并待发送的文本块，按批量或等待时间发送，摊薄每帧的序列化和写出开销
+        pending: list[str] = []
+        batch_size = Config.DEFAULT_MIN_BATCH_SIZE
+        flush_deadline = 0.0
+        
+        def flush_pending() -> bytes:
+            """把待发送文本合并为一个chunk帧，推进事件ID并放大下一批的批量"""
+            nonlocal event_id, batch_size
+            event_id += 1
+            frame = b"id: %d" % event_id + chunk_prefix + json_dumps("".join(pending)) + chunk_suffix
+            pending.clear()
+            batch_size = min(
+                batch_size * Config.DEFAULT_BATCH_SIZE_GROWTH_FACTOR,
+                Config.DEFAULT_BATCH_SIZE
+            )
+            return frame
+        
+        # 事件流在独立任务中消费，这里可以带超时等待下一个事件，保证缓冲文本按时发送
+        queue: asyncio.Queue = asyncio.Queue(maxsize=_EVENT_QUEUE_SIZE)
+        pump = asyncio.create_task(_pump_events(run_iter, queue))
         try:
-            async for event in run_iter:
-                if hasattr(event, 'content') and event.content.parts:
-                    for part in event.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            text_chunk = part.text
-                            full_response += text_chunk
-                            
-                            # 发送流式数据
-                            data = {
-                                "text": text_chunk,
-                                "session_id": session_id,
-                                "event_type": "chunk"
-                            }
-                            yield sse_generator.generate_sse_event(data, "message")
+            while True:
+                if pending and queue.empty():
+                    timeout = flush_deadline - time.monotonic()
+                    if timeout <= 0:
+                        yield flush_pending()
+                        continue
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        # 等待期间没有新事件，发送已缓冲的文本
+                        yield flush_pending()
+                        continue
+                else:
+                    item = await queue.get()
+                
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                event = item
+                
+                # 事件结构稳定，直接访问属性，仅在缺失时走异常分支
+                try:
+                    parts = event.content.parts
+                except AttributeError:
+                    parts = None
+                
+                has_text = False
+                if parts:
+                    for part in parts:
+                        text_chunk = part.text
+                        if text_chunk:
+                            if not pending:
+                                flush_deadline = time.monotonic() + Config.STREAM_FLUSH_INTERVAL
+                            full_parts.append(text_chunk)
+                            pending.append(text_chunk)
+                            has_text = True
                 
                 elif hasattr(event, 'agent_response'):
                     if event.agent_response and hasattr(event.agent_response, 'text'):
-                        # 发送完整响应
-                        data = {
-                            "text": event.agent_response.text,
-                            "session_id": session_id,
-                            "event_type": "complete",
-                            "full_response": full_response
-                        }
-                        yield sse_generator.generate_sse_event(data, "complete")
+                        # 发送剩余文本块和完整响应
+                        if pending:
+                            yield flush_pending()
+                        full_response = "".join(full_parts)
+                        event_id += 1
+                        yield _complete_event(event.agent_response.text, full_response, session_id, event_id)
+                        completed_sent = True
                         break
+                
+                # 达到批量，或本事件不含文本（如函数调用）时立即发送；
+                # 否则由上方的超时等待保证最迟在 STREAM_FLUSH_INTERVAL 后发送
+                if pending and (not has_text or len(pending) >= batch_size):
+                    yield flush_pending()
         
         except Exception as e:
             logger.error(f"Agent流处理错误: {e}")
             
-            # 如果流处理出错，发送错误信息
+            # 先发送已缓冲的文本，再发送错误信息
+            if pending:
+                yield flush_pending()
+            full_response = "".join(full_parts)
             error_data = {
                 "error": f"处理响应时出错: {str(e)}",
                 "session_id": session_id,
                 "event_type": "error",
                 "full_response": full_response if full_response else "抱歉，AI助手暂时无法响应。请稍后再试。"
             }
-            yield sse_generator.generate_sse_event(error_data, "error")
+            event_id += 1
+            yield _sse_event(error_data, "error", event_id)
             return
+        finally:
+            pump.cancel()
+        
+        if pending:
+            yield flush_pending()
         
         # 如果循环结束但没有收到complete事件，手动发送
-        if full_response:
-            data = {
-                "text": full_response,
-                "session_id": session_id,
-                "event_type": "complete",
-                "full_response": full_response
-            }
-            yield sse_generator.generate_sse_event(data, "complete")
-        else:
-            # 如果没有收到任何响应，发送默认响应
-            default_response = "我收到你的消息了！让我想想怎么用英语回答你..."
-            data = {
-                "text": default_response,
-                "session_id": session_id,
-                "event_type": "complete",
-                "full_response": default_response
-            }
-            yield sse_generator.generate_sse_event(data, "complete")
+        if not completed_sent:
+            full_response = "".join(full_parts)
+            if not full_response:
+                # 如果没有收到任何响应，发送默认响应
+                full_response = "我收到你的消息了！让我想想怎么用英语回答你..."
+            event_id += 1
+            yield _complete_event(full_response, full_response, session_id, event_id)
     
     except Exception as e:
-        print_exception_stack(e, "Agent流生成器错误")
-        logger.error(f"Agent流生成器错误: {e}")
+        logger.exception("Agent流生成器错误: %s", e)
         
         error_data = {
             "error": f"系统错误: {str(e)}",
             "event_type": "error"
         }
-        yield sse_generator.generate_sse_event(error_data, "error")
+        event_id += 1
+        yield _sse_event(error_data, "error", event_id)
+
+def _load_index_html() -> Optional[bytes]:
+    """启动时读取前端页面，避免每次请求都在事件循环中做同步文件读取"""
+    try:
+        with open("static/index.html", "rb") as f:
+            return f.read()
+    except OSError as e:
+        logger.warning(f"前端页面加载失败: {e}")
+        return None
+
+_INDEX_HTML = _load_index_html()
 
 @app.get("/", response_class=HTMLResponse)
 async def get_home():
     """返回前端页面"""
-    with open("static/index.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read(), status_code=200)
+    if _INDEX_HTML is None:
+        return HTMLResponse(content="前端页面不存在", status_code=404)
+    return HTMLResponse(content=_INDEX_HTML, status_code=200)
 
 @app.post("/api/start_session")
 async def start_session():
     """开始新的学习会话"""
     try:
-        user_id = f"user_{uuid.uuid4().hex[:8]}"
+        user_id = f"user_{secrets.token_hex(4)}"
         session = await runner.session_service.create_session(
             app_name="FunEnglishLearning",
             user_id=user_id
@@ -217,67 +334,54 @@ async def start_session():
         return {
             "success": False,
             "error": str(e),
-            "session_id": f"local_{int(time.time())}_{uuid.uuid4().hex[:8]}",
-            "user_id": f"user_{uuid.uuid4().hex[:8]}"
+            "session_id": f"local_{int(time.time())}_{secrets.token_hex(4)}",
+            "user_id": f"user_{secrets.token_hex(4)}"
         }
 
+async def _read_json(request: Request):
+    """读取并解析请求体JSON（orjson解码错误同样是 json.JSONDecodeError 的子类）"""
+    return json_loads(await request.body())
+
 @app.post("/api/chat/stream")
 async def chat_stream(request: Request):
     """与英语导师对话（流式响应）"""
     try:
-        data = await request.json()
+        data = await _read_json(request)
         user_input = data.get("message", "").strip()
         session_id = data.get("session_id", "").strip()
         user_id = data.get("user_id", "").strip()
         
         if not user_input:
-            error_data = {"error": "请输入消息"}
-            return StreamingResponse(
-                iter([sse_generator.generate_sse_event(error_data, "error")]),
-                media_type="text/event-stream"
-            )
+            return EventSourceResponse(iter([_EMPTY_MSG_FRAME]))
         
         logger.info(f"收到消息 - 会话: {session_id}, 用户: {user_id}, 消息: {user_input[:50]}...")
         
-        # 如果session_id为空，创建新会话
+        # 如果session_id为空，后台创建新会话，由流生成器在首次迭代时等待
+        session_task = None
         if not session_id:
-            session = await runner.session_service.create_session(
+            session_task = asyncio.create_task(runner.session_service.create_session(
                 app_name="FunEnglishLearning",
-                user_id=user_id or f"user_{uuid.uuid4().hex[:8]}"
-            )
-            session_id = session.id
-            user_id = session.user_id
+                user_id=user_id or f"user_{secrets.token_hex(4)}"
+            ))
         
-        # 返回流式响应
-        return StreamingResponse(
-            agent_stream_generator(user_input, session_id, user_id),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no"
-            }
+        # 返回流式响应，EventSourceResponse 自带 no-cache / X-Accel-Buffering 等响应头和心跳
+        return EventSourceResponse(
+            agent_stream_generator(user_input, session_id, user_id, session_task),
+            ping=15
         )
     
     except json.JSONDecodeError:
-        error_data = {"error": "请求格式错误"}
-        return StreamingResponse(
-            iter([sse_generator.generate_sse_event(error_data, "error")]),
-            media_type="text/event-stream"
-        )
+        return EventSourceResponse(iter([_BAD_REQUEST_FRAME]))
     except Exception as e:
         logger.error(f"聊天接口错误: {e}")
-        error_data = {"error": f"服务器错误: {str(e)}"}
-        return StreamingResponse(
-            iter([sse_generator.generate_sse_event(error_data, "error")]),
-            media_type="text/event-stream"
-        )
+        error_frame = _ERROR_FRAME_PREFIX + json_dumps(f"服务器错误: {str(e)}") + b"}\n\n"
+        return EventSourceResponse(iter([error_frame]))
 
 @app.post("/api/chat/direct")
 async def chat_direct(request: Request):
     """与英语导师对话（直接响应，用于测试）"""
     try:
-        data = await request.json()
+        data = await _read_json(request)
         user_input = data.get("message", "").strip()
         session_id = data.get("session_id", "").strip()
         user_id = data.get("user_id", "").strip()
@@ -289,7 +393,7 @@ async def chat_direct(request: Request):
         if not session_id:
             session = await runner.session_service.create_session(
                 app_name="FunEnglishLearning",
-                user_id=user_id or f"user_{uuid.uuid4().hex[:8]}"
+                user_id=user_id or f"user_{secrets.token_hex(4)}"
             )
             session_id = session.id
             user_id = session.user_id
@@ -313,10 +417,7 @@ async def chat_direct(request: Request):
                 user_id=user_id,
                 session_id=session_id,
                 new_message=content,
-                run_config=RunConfig(
-                    response_modalities=["TEXT"],
-                    max_llm_calls=10,
-                )
+                run_config=_DIRECT_RUN_CONFIG
             )
             
             response_text = ""
@@ -339,6 +440,8 @@ async def chat_direct(request: Request):
                 "user_id": user_id
             }
     
+    except json.JSONDecodeError:
+        return {"success": False, "error": "请求格式错误"}
     except Exception as e:
         logger.error(f"直接聊天接口错误: {e}")
         return {
@@ -365,24 +468,19 @@ async def get_session_info(user_id: str, session_id: str):
 
 @app.get("/health")
 async def health_check():
-    """健康检查端点"""
+    """健康检查端点（不创建会话，避免探针请求让内存会话表持续增长）"""
     try:
-        # 测试会话服务
-        test_session = await runner.session_service.create_session(
-            app_name="FunEnglishLearning",
-            user_id="test_user"
-        )
-        await runner.session_service.get_session(app_name=APP_NAME, user_id='user_id', session_id=test_session.id)
+        if runner.session_service is None:
+            raise RuntimeError("会话服务未初始化")
         
         return {
             "status": "healthy",
             "timestamp": time.time(),
             "service": "english_learning",
-            "await runner.session_service": "operational"
+            "session_service": "operational"
         }
     except Exception as e:
-        print_exception_stack(e, "健康检查失败")
-        logger.error(f"健康检查失败: {e}")
+        logger.exception("健康检查失败: %s", e)
         return {
             "status": "unhealthy",
             "timestamp": time.time(),
@@ -400,4 +498,12 @@ async def test_endpoint():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file
+    # loop/http 保持默认的 auto：已安装 uvloop、httptools 时自动启用，Windows 下回退到 asyncio
+    # 多核部署可改用 gunicorn -k uvicorn.workers.UvicornWorker
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        log_level="info",
+        workers=1
+    )
\ No newline at end of file
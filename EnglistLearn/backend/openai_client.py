@@ -1,19 +1,76 @@
 from __future__ import annotations
 
 import os
+import re
+import asyncio
 import logging
+import weakref
 from typing import AsyncGenerator, Optional
 from typing_extensions import override
 
+import httpx
 from openai import AsyncOpenAI
 from google.adk.models.base_llm import BaseLlm
 from google.adk.models.llm_request import LlmRequest
 from google.adk.models.llm_response import LlmResponse
 from google.genai import types
-from utils import print_exception_stack
+from utils import build_chat_messages, print_exception_stack
 
 logger = logging.getLogger(__name__)
 
+# 请求未携带 config 时使用的空配置，所有字段均为 None
+_EMPTY_CONFIG = types.GenerateContentConfig()
+
+# 支持的模型名称正则，模块加载时编译一次
+_SUPPORTED_MODEL_PATTERNS = tuple(
+    re.compile(p) for p in (r'qwen2\.5-.*', r'qwen2\.?5-.*-instruct')
+)
+_SUPPORTED_MODEL_STRS = [p.pattern for p in _SUPPORTED_MODEL_PATTERNS]
+
+# 请求超时：总计 30 秒，建立连接最多 5 秒（同时传给 AsyncOpenAI，避免被其默认值覆盖）
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+# 按事件循环共享 HTTP/2 连接池，并在池内按 (api_key, base_url) 复用 AsyncOpenAI 客户端；
+# 以弱引用关联事件循环，循环结束后对应条目自动移除
+_shared_pools: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop,
+    tuple[httpx.AsyncClient, dict[tuple[str, str], AsyncOpenAI]]
+] = weakref.WeakKeyDictionary()
+
+
+def _get_shared_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    """获取当前事件循环的共享 AsyncOpenAI 客户端，连接池不存在或已关闭时创建"""
+    loop = asyncio.get_running_loop()
+    pool = _shared_pools.get(loop)
+    if pool is None or pool[0].is_closed:
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=_HTTP_TIMEOUT,
+        )
+        pool = _shared_pools[loop] = (http_client, {})
+    
+    http_client, clients = pool
+    key = (api_key, base_url)
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=_HTTP_TIMEOUT,
+            http_client=http_client,
+        )
+    return client
+
+
+async def close_shared_clients():
+    """关闭所有共享的 HTTP 连接池，应在应用退出时调用"""
+    pools = list(_shared_pools.values())
+    _shared_pools.clear()
+    for http_client, _ in pools:
+        if not http_client.is_closed:
+            await http_client.aclose()
+
 
 class OpenAILlm(BaseLlm):
     """OpenAI 模型适配器 - 使用官方 AsyncOpenAI 客户端"""
@@ -33,12 +90,8 @@ class OpenAILlm(BaseLlm):
         self._api_key = api_key or self._get_api_key()
         self._base_url = base_url
         
-        # 初始化 OpenAI 客户端
-        self._client = AsyncOpenAI(
-            api_key=self._api_key,
-            base_url=self._base_url,
-            timeout=30.0,  # 30秒超时
-        )
+        # 共享客户端与事件循环绑定，在每次调用时获取
+        self._client: Optional[AsyncOpenAI] = None
         
         # 存储默认参数
         self._default_temperature = kwargs.get("temperature", 0.7)
@@ -55,53 +108,31 @@ class OpenAILlm(BaseLlm):
     
     def _convert_to_openai_messages(self, request: LlmRequest) -> list[dict]:
         """将 LlmRequest 转换为 OpenAI API 的消息格式"""
-        messages = []
-        
-        # 处理系统指令
-        if request.config and hasattr(request.config, 'system_instruction') and request.config.system_instruction:
-            messages.append({
-                "role": "system",
-                "content": request.config.system_instruction
-            })
-        
-        # 处理对话历史
-        for content in request.contents:
-            # 确定角色：user 或 assistant
-            role = "user" if content.role in ["user", "USER"] else "assistant"
-            
-            # 提取文本内容
-            text_parts = []
-            for part in content.parts:
-                if hasattr(part, "text") and part.text:
-                    text_parts.append(part.text)
-            
-            if text_parts:
-                messages.append({
-                    "role": role,
-                    "content": "\n".join(text_parts)
-                })
-        
-        return messages
+        return build_chat_messages(
+            (request.config or _EMPTY_CONFIG).system_instruction,
+            request.contents
+        )
     
     def _get_generation_parameters(self, request: LlmRequest) -> dict:
         """获取生成参数"""
-        config = request.config
-        
+        cfg = request.config or _EMPTY_CONFIG
+        temperature = cfg.temperature
+        max_tokens = cfg.max_output_tokens
         params = {
             "model": self._model_name,
-            "temperature": getattr(config, "temperature", self._default_temperature),
-            "max_tokens": getattr(config, "max_output_tokens", self._default_max_tokens),
+            "temperature": self._default_temperature if temperature is None else temperature,
+            "max_tokens": self._default_max_tokens if max_tokens is None else max_tokens,
         }
         
         # 可选参数
-        if config and hasattr(config, "top_p") and config.top_p is not None:
-            params["top_p"] = config.top_p
+        if cfg.top_p is not None:
+            params["top_p"] = cfg.top_p
         
-        if config and hasattr(config, "frequency_penalty") and config.frequency_penalty is not None:
-            params["frequency_penalty"] = config.frequency_penalty
+        if cfg.frequency_penalty is not None:
+            params["frequency_penalty"] = cfg.frequency_penalty
         
-        if config and hasattr(config, "presence_penalty") and config.presence_penalty is not None:
-            params["presence_penalty"] = config.presence_penalty
+        if cfg.presence_penalty is not None:
+            params["presence_penalty"] = cfg.presence_penalty
         
         return params
     
@@ -112,6 +143,8 @@ class OpenAILlm(BaseLlm):
         stream: bool = False
     ) -> AsyncGenerator[LlmResponse, None]:
         """发送请求到 OpenAI 模型"""
+        # 每次调用重新获取共享客户端（仅一次字典查找），连接池被关闭后会自动重建
+        self._client = _get_shared_client(self._api_key, self._base_url)
         
         # 构建请求参数
         messages = self._convert_to_openai_messages(llm_request)
@@ -201,16 +234,15 @@ class OpenAILlm(BaseLlm):
         """解析 OpenAI API 响应（非流式）"""
         try:
             # 提取生成的文本
-            text = ""
-            if response.choices and response.choices[0].message:
-                text = response.choices[0].message.content or ""
+            # OpenAI SDK 保证 choices[0].message 的结构，直接访问属性
+            choice = response.choices[0]
+            text = choice.message.content or ""
             
             # 处理使用情况统计
             usage = response.usage
             
             # 处理完成原因
-            finish_reason_str = response.choices[0].finish_reason if response.choices else "stop"
-            finish_reason = self._map_finish_reason(finish_reason_str)
+            finish_reason = self._map_finish_reason(choice.finish_reason or "stop")
             
             return LlmResponse(
                 content=types.Content(
@@ -250,18 +282,14 @@ class OpenAILlm(BaseLlm):
         return mapping.get(openai_finish_reason.lower(), types.FinishReason.STOP)
     
     async def close(self):
-        """关闭 OpenAI 客户端"""
-        if self._client:
-            await self._client.close()
+        """释放实例对客户端的引用；共享连接池由应用退出时的 close_shared_clients 关闭"""
+        self._client = None
     
     @classmethod
     @override
     def supported_models(cls) -> list[str]:
-        """提供支持的模型列表"""
-        return [
-            r'qwen2\.5-.*',
-            r'qwen2\.?5-.*-instruct',
-        ]
+        """提供支持的模型列表（返回共享列表，调用方不应修改）"""
+        return _SUPPORTED_MODEL_STRS
 
 
 def create_openai_llm(
@@ -2,20 +2,299 @@ from __future__ import annotations
 
 import os
 import re
+import time
+import asyncio
 import json
 import logging
+import functools
+import weakref
 from typing import AsyncGenerator, Optional
 from typing_extensions import override
-import aiohttp
+import httpx
 
 from google.adk.models.base_llm import BaseLlm
 from google.adk.models.llm_request import LlmRequest
 from google.adk.models.llm_response import LlmResponse
 from google.genai import types
-from utils import print_exception_stack
+from utils import build_chat_messages, json_dumps, json_loads
 
 logger = logging.getLogger(__name__)
 
+# 请求未携带 config 时使用的空配置，所有字段均为 None
+_EMPTY_CONFIG = types.GenerateContentConfig()
+
+# Markdown 代码块相关正则，模块加载时编译一次
+# 匹配整行的代码块标记（```、```json）及其换行符
+_FENCE_RE = re.compile(r'^[^\S\n]*```(?:json)?[^\S\n]*(?:\n|$)', re.MULTILINE)
+_EXTRACT_PATTERN = re.compile(r'```(?:json)?\s*([\s\S]*?)```', re.IGNORECASE)
+
+# JSON 提取：定位候选起点后交给 C 实现的解码器确定结束位置
+_JSON_START_RE = re.compile(r'[\[{]')
+_DECODER = json.JSONDecoder()
+
+# 支持的模型名称：合并原先相互重叠的两条规则（qwen2.5-* 与 qwen2?5-*-instruct）
+_SUPPORTED_RE = re.compile(r'qwen2(?:\.5-.*|5-.*-instruct)')
+
+# JSON 流扫描时只需关注的结构字符
+_JSON_SCAN_RE = re.compile(rb'[{}"\\]')
+
+# 千问完成原因到 ADK FinishReason 的映射（千问返回的均为小写）
+_FINISH_REASON_MAP = {
+    "stop": types.FinishReason.STOP,
+    "length": types.FinishReason.MAX_TOKENS,
+    "content_filter": types.FinishReason.SAFETY,
+    "function_call": types.FinishReason.STOP,
+    "tool_calls": types.FinishReason.STOP,
+}
+
+
+class _JsonObjectScanner:
+    """增量扫描流中的顶层 JSON 对象，已扫描过的字节不会重复检查
+    
+    直接在原始字节上扫描：UTF-8 多字节字符不会包含 ASCII 结构字符，
+    因此无需先解码，也不会在分块边界截断多字节字符。
+    """
+    
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0        # 下一次扫描的起始位置
+        self._depth = 0      # 当前大括号嵌套深度
+        self._start = 0      # 当前对象在缓冲区中的起始位置
+        self._in_string = False
+    
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """追加数据，返回本次新出现的完整 JSON 对象字节串"""
+        buf = self._buffer
+        buf.extend(chunk)
+        objects = []
+        pos = self._pos
+        
+        while True:
+            match = _JSON_SCAN_RE.search(buf, pos)
+            if match is None:
+                break
+            char = match.group()
+            pos = match.end()
+            
+            if self._in_string:
+                if char == b'\\':
+                    pos += 1  # 跳过被转义的字符
+                elif char == b'"':
+                    self._in_string = False
+            elif char == b'"':
+                # 只跟踪对象内部的字符串，对象之间的内容直接忽略
+                self._in_string = self._depth > 0
+            elif char == b'{':
+                if self._depth == 0:
+                    self._start = match.start()
+                self._depth += 1
+            elif char == b'}' and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(bytes(buf[self._start:pos]))
+        
+        # 原地丢弃已处理的部分，只保留未完成的对象
+        cut = self._start if self._depth > 0 else min(pos, len(buf))
+        del buf[:cut]
+        self._pos = pos - cut
+        self._start = 0
+        return objects
+
+
+def _extract_from_output(data: dict) -> tuple[str, Optional[str]]:
+    """从 DashScope 原生格式（output.text）中提取文本和完成原因"""
+    output = data.get("output") or {}
+    finish_reason = output.get("finish_reason")
+    # DashScope 在中间分块中以字符串 "null" 表示尚未结束
+    if finish_reason == "null":
+        finish_reason = None
+    return output.get("text") or "", finish_reason
+
+
+def _extract_from_choices(data: dict) -> tuple[str, Optional[str]]:
+    """从 OpenAI 兼容格式（choices[0].message / delta）中提取文本和完成原因"""
+    choices = data.get("choices")
+    if not choices:
+        return "", None
+    choice = choices[0]
+    get = choice.get
+    body = get("message") or get("delta") or {}
+    return body.get("content") or "", get("finish_reason")
+
+
+class _IncrementTracker:
+    """把流式分块中的文本转换为增量
+    
+    DashScope 原生格式的 output.text 为单调增长的累积文本，只需记录已发送的长度并切出新增部分，
+    不再逐块比较整个前缀；OpenAI 兼容格式的 delta.content 本身就是增量，直接返回。
+    """
+    
+    def __init__(self):
+        self._sent_len = 0
+    
+    def increment(self, text: str, cumulative: bool) -> str:
+        """返回本次新增的文本，没有新增时返回空字符串"""
+        if not cumulative:
+            return text
+        sent_len = self._sent_len
+        if len(text) > sent_len:
+            self._sent_len = len(text)
+            return text[sent_len:]
+        return ""
+
+
+# 超过该长度的文本不进入缓存，避免缓存大块内容
+_CLEAN_CACHE_MAX_LEN = 4096
+
+
+def _strip_markdown_fences(text: str) -> str:
+    """删除代码块标记行；若结果为空则提取第一个代码块的内容"""
+    text = text.strip()
+    
+    # 一次替换删除所有代码块标记行，保留其余内容
+    result = _FENCE_RE.sub('', text).strip()
+    
+    # 如果结果为空，尝试直接提取代码块内容
+    if not result:
+        match = _EXTRACT_PATTERN.search(text)
+        if match:
+            # 返回第一个匹配的内容
+            return match.group(1).strip()
+    
+    return result
+
+
+_strip_markdown_fences_cached = functools.lru_cache(maxsize=2048)(_strip_markdown_fences)
+
+
+def _clean_markdown_json(text: str) -> str:
+    """清理 Markdown 代码块，专注于提取 JSON 字符串"""
+    if not text or not isinstance(text, str):
+        return ""
+    
+    # 快速路径：大多数流式片段不含代码块标记
+    if '```' not in text:
+        return text.strip()
+    
+    if len(text) > _CLEAN_CACHE_MAX_LEN:
+        return _strip_markdown_fences(text)
+    return _strip_markdown_fences_cached(text)
+
+
+# pydantic v2 的 model_construct 不可用时回退到普通构造
+_MODEL_CONSTRUCT = hasattr(types.Content, "model_construct")
+
+
+def _assistant_content(text: str) -> types.Content:
+    """构建纯文本的 assistant 内容，字段已知合法，跳过 pydantic 校验"""
+    if _MODEL_CONSTRUCT:
+        return types.Content.model_construct(
+            parts=[types.Part.model_construct(text=text)],
+            role="assistant"
+        )
+    return types.Content(parts=[types.Part(text=text)], role="assistant")
+
+
+def _text_response(text: str) -> LlmResponse:
+    """构建中间文本分块的响应"""
+    return LlmResponse(
+        content=_assistant_content(text),
+        finish_reason=None,  # 中间chunk没有完成原因
+    )
+
+
+# 增量文本合并阈值：累计字符数或距上次发送的时间（秒），约为一帧
+_FLUSH_CHARS = 64
+_FLUSH_INTERVAL = 0.016
+
+
+class _TextBatcher:
+    """合并短时间内到达的增量文本，减少逐 token 构建响应对象和事件循环切换
+    
+    时间窗口只在新文本到达时检查，调用方需在每个网络分块处理完后调用 flush，
+    保证已收到的文本不会滞留到下一个增量到达。
+    """
+    
+    def __init__(self):
+        self._parts: list[str] = []
+        self._size = 0
+        # 首个增量立即发送，不增加首字延迟
+        self._last_flush = float("-inf")
+    
+    def add(self, text: str) -> Optional[str]:
+        """加入增量文本，达到合并阈值时返回待发送的文本"""
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= _FLUSH_CHARS or time.monotonic() - self._last_flush > _FLUSH_INTERVAL:
+            return self.flush()
+        return None
+    
+    def flush(self) -> Optional[str]:
+        """取出所有未发送的文本，没有时返回 None"""
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._last_flush = time.monotonic()
+        return text
+
+
+# 请求超时：非流式 30 秒，流式读取允许 300 秒
+_DEFAULT_TIMEOUT = httpx.Timeout(30.0)
+_STREAM_TIMEOUT = httpx.Timeout(30.0, read=300.0)
+
+# 超过该大小的非流式响应体在线程池中解析，避免阻塞事件循环
+_OFFLOAD_PARSE_SIZE = 256_000
+
+# 限制同一事件循环内同时进行的千问请求数量，避免并发生成压垮连接池
+_MAX_CONCURRENT_REQUESTS = 32
+
+# 批量生成时单个批次内同时发出的请求数上限
+_BATCH_CONCURRENCY = 16
+
+# 按事件循环共享的 HTTP/2 客户端，并发请求在同一连接上多路复用；
+# 以弱引用关联事件循环，循环结束后对应条目自动移除
+_shared_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = weakref.WeakKeyDictionary()
+# 信号量与客户端一样按事件循环分别创建，不能跨循环使用
+_request_semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+
+
+def _get_shared_client() -> httpx.AsyncClient:
+    """获取当前事件循环的共享客户端，不存在或已关闭时创建"""
+    loop = asyncio.get_running_loop()
+    client = _shared_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=True,
+            timeout=_DEFAULT_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=32,
+                keepalive_expiry=75
+            )
+        )
+        _shared_clients[loop] = client
+    return client
+
+
+def _get_request_semaphore() -> asyncio.Semaphore:
+    """获取当前事件循环的请求信号量，不存在时创建"""
+    loop = asyncio.get_running_loop()
+    semaphore = _request_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _request_semaphores[loop] = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+    return semaphore
+
+
+async def close_shared_clients():
+    """关闭所有共享客户端，应在应用退出时调用"""
+    clients = list(_shared_clients.values())
+    _shared_clients.clear()
+    for client in clients:
+        if not client.is_closed:
+            await client.aclose()
+
 
 class QwenLlm(BaseLlm):
     """千问模型适配器 - 完全遵循ADK框架规范"""
@@ -35,10 +314,20 @@ class QwenLlm(BaseLlm):
         self._api_key = api_key or self._get_api_key()
         self._base_url = base_url
         
-        # 初始化会话
-        self._session = None
+        # 请求地址和请求头在实例生命周期内不变，只构建一次
+        self._url = f"{base_url}/services/aigc/text-generation/generation"
+        self._headers = {
+            "Authorization": f"Bearer {self._api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        # 初始化客户端
+        self._client = None
         self._default_temperature = kwargs.get("temperature", 0.7)
         self._default_max_tokens = kwargs.get("max_tokens", 2048)
+        
+        # 响应格式在同一接口下固定，识别一次后复用对应的提取函数
+        self._extract_fn = None
     
     def _get_api_key(self) -> str:
         """从环境变量获取 API Key"""
@@ -49,61 +338,45 @@ class QwenLlm(BaseLlm):
             )
         return api_key
     
-    async def _ensure_session(self):
-        """确保 aiohttp session 存在"""
-        if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=30)
-            )
+    def _ensure_client(self):
+        """获取当前事件循环的共享客户端（仅一次字典查找，已关闭时会重建）"""
+        self._client = _get_shared_client()
+    
+    async def __aenter__(self) -> QwenLlm:
+        self._ensure_client()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
     
     def _convert_to_qwen_messages(self, request: LlmRequest) -> list[dict]:
         """将 LlmRequest 转换为千问 API 的消息格式"""
-        messages = []
-        
-        # 处理系统指令
-        if request.config and hasattr(request.config, 'system_instruction') and request.config.system_instruction:
-            messages.append({
-                "role": "system",
-                "content": request.config.system_instruction
-            })
-        
-        # 处理对话历史
-        for content in request.contents:
-            # 确定角色：user 或 assistant
-            role = "user" if content.role in ["user", "USER"] else "assistant"
-            
-            # 提取文本内容
-            text_parts = []
-            for part in content.parts:
-                if hasattr(part, "text") and part.text:
-                    text_parts.append(part.text)
-            
-            if text_parts:
-                messages.append({
-                    "role": role,
-                    "content": "\n".join(text_parts)
-                })
-        
-        return messages
+        return build_chat_messages(
+            (request.config or _EMPTY_CONFIG).system_instruction,
+            request.contents
+        )
     
     def _convert_to_qwen_parameters(self, request: LlmRequest) -> dict:
         """转换生成参数"""
-        config = request.config
-        
+        cfg = request.config or _EMPTY_CONFIG
+        temperature = cfg.temperature
+        max_tokens = cfg.max_output_tokens
         params = {
-            "temperature": getattr(config, "temperature", 0.7),
-            "max_tokens": getattr(config, "max_output_tokens", 2048),
+            "temperature": self._default_temperature if temperature is None else temperature,
+            "max_tokens": self._default_max_tokens if max_tokens is None else max_tokens,
         }
         
         # 可选参数
-        if config and hasattr(config, "top_p") and config.top_p is not None:
-            params["top_p"] = config.top_p
+        if cfg.top_p is not None:
+            params["top_p"] = cfg.top_p
         
-        if config and hasattr(config, "top_k") and config.top_k is not None:
-            params["top_k"] = config.top_k
+        if cfg.top_k is not None:
+            params["top_k"] = cfg.top_k
         
-        if config and hasattr(config, "repetition_penalty") and config.repetition_penalty is not None:
-            params["repetition_penalty"] = config.repetition_penalty
+        # repetition_penalty 不是 GenerateContentConfig 的标准字段，单次字典查找
+        repetition_penalty = cfg.__dict__.get("repetition_penalty")
+        if repetition_penalty is not None:
+            params["repetition_penalty"] = repetition_penalty
         
         return params
     
@@ -114,7 +387,7 @@ class QwenLlm(BaseLlm):
         stream: bool = False
     ) -> AsyncGenerator[LlmResponse, None]:
         """发送请求到千问模型"""
-        await self._ensure_session()
+        self._ensure_client()
         
         # 构建请求体
         payload = {
@@ -128,10 +401,8 @@ class QwenLlm(BaseLlm):
             }
         }
         
-        headers = {
-            "Authorization": f"Bearer {self._api_key}",
-            "Content-Type": "application/json"
-        }
+        # 请求体只序列化一次，以字节直接发送
+        body = json_dumps(payload)
         
         logger.info(
             '发送千问API请求, 模型: %s, 流式: %s',
@@ -141,26 +412,34 @@ class QwenLlm(BaseLlm):
         
         try:
             if not stream:
-                # 非流式调用
-                async with self._session.post(
-                    f"{self._base_url}/services/aigc/text-generation/generation",
-                    headers=headers,
-                    json=payload
-                ) as response:
+                # 非流式调用，只在收发请求期间占用信号量
+                async with _get_request_semaphore():
+                    response = await self._client.post(
+                        self._url,
+                        headers=self._headers,
+                        content=body,
+                        timeout=_DEFAULT_TIMEOUT
+                    )
                     response.raise_for_status()
-                    data = await response.json()
-                    
-                    llm_response = self._parse_qwen_response(data)
-                    logger.debug('接收到千问非流式响应')
-                    yield llm_response
+                    raw = response.content
+                
+                if len(raw) > _OFFLOAD_PARSE_SIZE:
+                    data = await asyncio.get_running_loop().run_in_executor(None, json_loads, raw)
+                else:
+                    data = json_loads(raw)
+                
+                llm_response = self._parse_qwen_response(data)
+                logger.debug('接收到千问非流式响应')
+                yield llm_response
                     
             else:
                 # 流式调用 - 核心修复点
-                async with self._session.post(
-                    f"{self._base_url}/services/aigc/text-generation/generation",
-                    headers=headers,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=300)
+                async with _get_request_semaphore(), self._client.stream(
+                    "POST",
+                    self._url,
+                    headers=self._headers,
+                    content=body,
+                    timeout=_STREAM_TIMEOUT
                 ) as response:
                     response.raise_for_status()
                     
@@ -181,178 +460,85 @@ class QwenLlm(BaseLlm):
         except Exception as e:
             logger.error(f"千问API调用出错: {e}")
             raise
-        finally:
-            await self.close()
 
-    def _clean_markdown_json(self, text: str) -> str:
-        """清理 Markdown 代码块，专注于提取 JSON 字符串"""
-        if not text or not isinstance(text, str):
-            return ""
+    async def generate_batch(self, requests: list[LlmRequest]) -> list[LlmResponse]:
+        """并发发送多个非流式请求，按输入顺序返回响应（共享同一客户端的连接）"""
+        if not requests:
+            return []
         
-        text = text.strip()
-        
-        # 正则表达式：匹配代码块开始标记
-        code_block_start = re.compile(r'^\s*```(?:json)?\s*$')
-        code_block_end = re.compile(r'^\s*```\s*$')
-        
-        lines = text.split('\n')
-        cleaned_lines = []
-        in_code_block = False
+        self._ensure_client()
+        semaphore = asyncio.Semaphore(_BATCH_CONCURRENCY)
         
-        for line in lines:
-            # 检查是否是代码块开始
-            if code_block_start.match(line):
-                in_code_block = True
-                continue
-            # 检查是否是代码块结束
-            elif in_code_block and code_block_end.match(line):
-                in_code_block = False
-                continue
-            # 如果不在代码块中，保留该行
-            elif not in_code_block:
-                cleaned_lines.append(line)
-            # 在代码块中，保留内容行
-            else:
-                cleaned_lines.append(line)
-        
-        # 重新组合文本
-        result = '\n'.join(cleaned_lines)
-        
-        # 如果结果为空，尝试直接提取代码块内容
-        if not result.strip():
-            # 使用正则表达式提取代码块内容
-            extract_pattern = r'```(?:json)?\s*([\s\S]*?)```'
-            matches = re.findall(extract_pattern, text, re.IGNORECASE)
-            if matches:
-                # 返回第一个匹配的内容
-                return matches[0].strip()
+        async def generate_one(llm_request: LlmRequest) -> LlmResponse:
+            async with semaphore:
+                agen = self.generate_content_async(llm_request, stream=False)
+                try:
+                    return await agen.__anext__()
+                finally:
+                    await agen.aclose()
         
-        return result.strip()
+        return await asyncio.gather(*(generate_one(r) for r in requests))
+
+    def _clean_markdown_json(self, text: str) -> str:
+        """清理 Markdown 代码块，专注于提取 JSON 字符串"""
+        return _clean_markdown_json(text)
     
     def _extract_json_string(self, text: str) -> str:
         """从文本中提取 JSON 字符串（支持对象和数组）"""
         # 移除文本两端的空白字符
         text = text.strip()
         
-        # 模式1：尝试提取完整的 JSON（对象或数组）
-        json_pattern = r'(?s)(\{.*\}|\[.*\])'
-        
-        # 模式2：更精确的匹配，支持嵌套
-        # 这个模式会匹配从第一个 '{' 或 '[' 开始到最后一个匹配的 '}' 或 ']' 的内容
-        json_pattern_advanced = r'(?s)((?:\[(?:[^\[\]]|(?1))*\]|\{(?:[^{}]|(?1))*\}))'
-        
-        # 模式3：简单但有效的提取，匹配最外层的大括号或中括号
-        json_pattern_simple = r'(?s)([\[\{](?:[^\[\]\{\}]|(?R))*[\]\}])'
+        # 依次尝试每个 '{' 或 '[' 起点，raw_decode 会正确处理字符串和转义
+        match = _JSON_START_RE.search(text)
+        while match:
+            pos = match.start()
+            try:
+                _, end = _DECODER.raw_decode(text, pos)
+                return text[pos:end]
+            except json.JSONDecodeError:
+                match = _JSON_START_RE.search(text, pos + 1)
         
-        try:
-            # 首先尝试匹配最外层的 JSON 结构
-            import regex
-            match = regex.search(json_pattern_simple, text)
-            if match:
-                json_str = match.group(0)
-                # 验证是否为有效的 JSON
-                try:
-                    json.loads(json_str)
-                    return json_str
-                except json.JSONDecodeError:
-                    pass
-            
-            # 如果 regex 不可用，使用标准 re 的简化方法
-            # 查找第一个可能的开始标记
-            start_chars = {'{': '}', '[': ']'}
-            for start_char, end_char in start_chars.items():
-                start_idx = text.find(start_char)
-                if start_idx != -1:
-                    # 使用栈匹配找到对应的结束标记
-                    stack = []
-                    for i in range(start_idx, len(text)):
-                        char = text[i]
-                        if char == start_char:
-                            stack.append(char)
-                        elif char == end_char:
-                            if stack and stack[-1] == start_char:
-                                stack.pop()
-                            if not stack:  # 栈为空，找到匹配的结束位置
-                                json_str = text[start_idx:i+1]
-                                # 验证 JSON 格式
-                                try:
-                                    json.loads(json_str)
-                                    return json_str
-                                except json.JSONDecodeError:
-                                    continue  # 继续查找下一个可能的 JSON
-            return text
-        except Exception:
-            # 如果所有方法都失败，返回原始文本
-            return text
+        # 没有找到有效的 JSON，返回原始文本
+        return text
     
-    async def _process_json_stream(self, response: aiohttp.ClientResponse) -> AsyncGenerator[LlmResponse, None]:
+    async def _process_json_stream(self, response: httpx.Response) -> AsyncGenerator[LlmResponse, None]:
         """处理JSON格式的流式响应"""
-        buffer = ""
-        accumulated_text = ""
+        scanner = _JsonObjectScanner()
+        batcher = _TextBatcher()
+        tracker = _IncrementTracker()
         
-        async for chunk in response.content.iter_any():
+        async for chunk in response.aiter_bytes():
             if not chunk:
                 continue
             
-            chunk_str = chunk.decode('utf-8', errors='ignore')
-            buffer += chunk_str
-            
-            # 尝试解析完整的JSON对象
-            try:
-                # 寻找完整的JSON对象边界
-                start = buffer.find('{')
-                end = buffer.rfind('}')
-                
-                if start != -1 and end != -1 and end > start:
-                    json_str = buffer[start:end+1]
-                    # 移除已处理的部分
-                    buffer = buffer[end+1:]
-                    
-                    data = json.loads(json_str)
+            # 增量扫描新数据，逐个解析完整的JSON对象
+            for json_str in scanner.feed(chunk):
+                try:
+                    data = json_loads(json_str)
                     
                     # 提取文本和完成原因
-                    current_text = ""
-                    finish_reason_str = None
-                    usage_data = None
-                    
-                    if "output" in data:
-                        output = data.get("output", {})
-                        current_text = output.get("text", "")
-                        finish_reason_str = output.get("finish_reason")
-                    elif "choices" in data:
-                        choices = data.get("choices", [])
-                        if choices:
-                            choice = choices[0]
-                            if "message" in choice:
-                                current_text = choice["message"].get("content", "")
-                                finish_reason_str = choice.get("finish_reason")
-                            elif "delta" in choice:
-                                current_text = choice["delta"].get("content", "")
-                                finish_reason_str = choice.get("finish_reason")
+                    current_text, finish_reason_str = self._extract_text_and_finish(data)
                     
                     # 处理使用情况
-                    if "usage" in data:
-                        usage_data = data["usage"]
+                    usage_data = data.get("usage")
                     
                     # 计算增量文本
-                    if current_text and current_text.startswith(accumulated_text):
-                        incremental_text = current_text[len(accumulated_text):]
-                        accumulated_text = current_text
-                        
-                        if incremental_text:
-                            cleaned_text = self._clean_markdown_json(incremental_text)
-                            # 返回增量部分
-                            yield LlmResponse(
-                                content=types.Content(
-                                    parts=[types.Part(text=cleaned_text)],
-                                    role="assistant"
-                                ),
-                                finish_reason=None,  # 中间chunk没有完成原因
-                                # model_version=self._model_name
-                            )
+                    incremental_text = tracker.increment(
+                        current_text, self._extract_fn is _extract_from_output
+                    )
+                    if incremental_text:
+                        cleaned_text = self._clean_markdown_json(incremental_text)
+                        # 返回增量部分（合并后发送）
+                        text = batcher.add(cleaned_text)
+                        if text:
+                            yield _text_response(text)
                     
-                    # 如果有完成原因，发送最终响应
+                    # 如果有完成原因，先发送剩余文本，再发送最终响应
                     if finish_reason_str:
+                        text = batcher.flush()
+                        if text:
+                            yield _text_response(text)
+                        
                         # 映射完成原因
                         finish_reason = self._map_finish_reason(finish_reason_str)
                         
@@ -371,80 +557,74 @@ class QwenLlm(BaseLlm):
                             # model_version=self._model_name
                         )
                         
-            except json.JSONDecodeError:
-                # JSON不完整，等待更多数据
-                continue
-            except Exception as e:
-                print_exception_stack(e, "解析JSON出错")
-                logger.warning(f"解析JSON出错: {e}")
-                continue
+                except json.JSONDecodeError as e:
+                    logger.warning(f"JSON解析错误: {e}, json_str: {json_str.decode('utf-8', errors='replace')}")
+                    continue
+                except Exception as e:
+                    logger.exception("解析JSON出错: %s", e)
+                    continue
+            
+            # 本分块内的增量已合并，发送剩余文本，避免等待下一个分块
+            text = batcher.flush()
+            if text:
+                yield _text_response(text)
+        
+        text = batcher.flush()
+        if text:
+            yield _text_response(text)
     
-    async def _process_sse_stream(self, response: aiohttp.ClientResponse) -> AsyncGenerator[LlmResponse, None]:
+    async def _process_sse_stream(self, response: httpx.Response) -> AsyncGenerator[LlmResponse, None]:
         """处理SSE格式的流式响应"""
-        buffer = ""
-        accumulated_text = ""
+        # 以字节累积，只在取出完整的一行后才处理
+        buffer = bytearray()
+        batcher = _TextBatcher()
+        tracker = _IncrementTracker()
         
-        async for chunk in response.content.iter_any():
+        async for chunk in response.aiter_bytes():
             if not chunk:
                 continue
             
-            chunk_str = chunk.decode('utf-8', errors='ignore')
-            buffer += chunk_str
+            buffer.extend(chunk)
             
             # 处理SSE格式：data: {json}\n\n
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                line = line.strip()
+            # 按偏移逐行扫描，本批数据处理完后再一次性删除已消费的前缀
+            start = 0
+            idx = buffer.find(b'\n')
+            while idx != -1:
+                line = buffer[start:idx].strip()
+                start = idx + 1
+                idx = buffer.find(b'\n', start)
                 
                 if not line:
                     continue
                 
-                if line.startswith('data: '):
+                if line.startswith(b'data: '):
                     data_str = line[6:]  # 移除 "data: " 前缀
                     
-                    if data_str == '[DONE]':
+                    if data_str == b'[DONE]':
                         break
                     
                     try:
-                        data = json.loads(data_str)
+                        data = json_loads(data_str)
                         
                         # 提取文本和完成原因
-                        current_text = ""
-                        finish_reason_str = None
-                        
-                        if "output" in data:
-                            output = data.get("output", {})
-                            current_text = output.get("text", "")
-                            finish_reason_str = output.get("finish_reason")
-                        elif "choices" in data:
-                            choices = data.get("choices", [])
-                            if choices:
-                                choice = choices[0]
-                                if "message" in choice:
-                                    current_text = choice["message"].get("content", "")
-                                    finish_reason_str = choice.get("finish_reason")
-                                elif "delta" in choice:
-                                    current_text = choice["delta"].get("content", "")
-                                    finish_reason_str = choice.get("finish_reason")
+                        current_text, finish_reason_str = self._extract_text_and_finish(data)
                         
                         # 计算增量文本
-                        if current_text and current_text.startswith(accumulated_text):
-                            incremental_text = current_text[len(accumulated_text):]
-                            accumulated_text = current_text
-                            
-                            if incremental_text:
-                                # 返回增量部分
-                                yield LlmResponse(
-                                    content=types.Content(
-                                        parts=[types.Part(text=incremental_text)],
-                                        role="assistant"
-                                    ),
-                                    finish_reason=None,  # 中间chunk没有完成原因
-                                    # model_version=self._model_name
-                                )
+                        incremental_text = tracker.increment(
+                            current_text, self._extract_fn is _extract_from_output
+                        )
+                        if incremental_text:
+                            # 返回增量部分（合并后发送）
+                            text = batcher.add(incremental_text)
+                            if text:
+                                yield _text_response(text)
                         
-                        # 如果有完成原因，发送最终响应
+                        # 如果有完成原因，先发送剩余文本，再发送最终响应
                         if finish_reason_str:
+                            text = batcher.flush()
+                            if text:
+                                yield _text_response(text)
                             finish_reason = self._map_finish_reason(finish_reason_str)
                             yield LlmResponse(
                                 content=None,
@@ -453,28 +633,47 @@ class QwenLlm(BaseLlm):
                             )
                             
                     except json.JSONDecodeError as e:
-                        logger.warning(f"JSON解析错误: {e}, data_str: {data_str}")
+                        logger.warning(f"JSON解析错误: {e}, data_str: {data_str.decode('utf-8', errors='replace')}")
                         continue
+            
+            del buffer[:start]
+            
+            # 本分块内的增量已合并，发送剩余文本，避免等待下一个分块
+            text = batcher.flush()
+            if text:
+                yield _text_response(text)
+        
+        text = batcher.flush()
+        if text:
+            yield _text_response(text)
+    
+    def _extract_text_and_finish(self, data: dict) -> tuple[str, Optional[str]]:
+        """提取响应中的文本和完成原因，首次识别出格式后跳过格式判断"""
+        extract = self._extract_fn
+        if extract is None:
+            if "output" in data:
+                extract = _extract_from_output
+            elif "choices" in data:
+                extract = _extract_from_choices
+            else:
+                return "", None
+            self._extract_fn = extract
+        return extract(data)
     
     def _parse_qwen_response(self, response_data: dict) -> LlmResponse:
         """解析千问API响应（非流式）"""
         try:
-            # 提取生成的文本
+            # 提取生成的文本（先置空，供下方异常分支使用）
             text = ""
-            if "output" in response_data:
-                output = response_data.get("output", {})
-                text = output.get("text", "")
-            elif "choices" in response_data:
-                choices = response_data.get("choices", [])
-                if choices:
-                    text = choices[0].get("message", {}).get("content", "")
+            text, finish_reason_str = self._extract_text_and_finish(response_data)
             
             # 处理使用情况统计
             usage = response_data.get("usage", {})
             
             # 处理完成原因
-            finish_reason_str = response_data.get("finish_reason", "stop")
-            finish_reason = self._map_finish_reason(finish_reason_str)
+            finish_reason = self._map_finish_reason(
+                finish_reason_str or response_data.get("finish_reason", "stop")
+            )
             
             return LlmResponse(
                 content=types.Content(
@@ -505,30 +704,26 @@ class QwenLlm(BaseLlm):
         if not qwen_finish_reason:
             return None
         
-        mapping = {
-            "stop": types.FinishReason.STOP,
-            "length": types.FinishReason.MAX_TOKENS,
-            "content_filter": types.FinishReason.SAFETY,
-            "function_call": types.FinishReason.STOP,
-            "tool_calls": types.FinishReason.STOP,
-        }
-        
-        return mapping.get(qwen_finish_reason.lower(), types.FinishReason.STOP)
+        # 常见情况下直接命中小写键，只有未命中时才转小写再查
+        reason = _FINISH_REASON_MAP.get(qwen_finish_reason)
+        if reason is None:
+            reason = _FINISH_REASON_MAP.get(qwen_finish_reason.lower(), types.FinishReason.STOP)
+        return reason
     
     async def close(self):
-        """关闭会话"""
-        if self._session and not self._session.closed:
-            await self._session.close()
-            self._session = None
+        """释放实例对客户端的引用；共享客户端由应用退出时的 close_shared_clients 关闭"""
+        self._client = None
     
     @classmethod
     @override
     def supported_models(cls) -> list[str]:
         """提供支持的模型列表"""
-        return [
-            r'qwen2\.5-.*',
-            r'qwen2\.?5-.*-instruct',
-        ]
+        return [_SUPPORTED_RE.pattern]
+    
+    @classmethod
+    def matches(cls, model_name: str) -> bool:
+        """判断模型名称是否受支持，使用预编译的正则"""
+        return _SUPPORTED_RE.fullmatch(model_name) is not None
 
 
 def create_qwen_llm(
@@ -1,5 +1,44 @@
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:  # orjson 不可用时回退到标准库 json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def json_dumps(data) -> bytes:
+    '''将对象序列化为 UTF-8 编码的 JSON 字节串，优先使用 orjson'''
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_loads(data):
+    '''解析 JSON 字符串或字节串，优先使用 orjson'''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def build_chat_messages(system_instruction, contents) -> list[dict]:
+    '''将系统指令和 ADK 对话内容转换为聊天消息列表（OpenAI 兼容接口与千问接口格式相同）'''
+    messages = []
+    if system_instruction:
+        messages.append({"role": "system", "content": system_instruction})
+    
+    for content in contents:
+        # 确定角色：user 或 assistant
+        role = "user" if content.role in ("user", "USER") else "assistant"
+        # 提取文本内容，没有文本的 Content 跳过
+        text_parts = [part.text for part in content.parts if part.text]
+        if text_parts:
+            messages.append({"role": role, "content": "\n".join(text_parts)})
+    return messages
+
+
 def print_exception_stack(e: Exception, context: str = ""):
-    '''打印异常堆栈，并可以附加上下文信息'''
-    import traceback
-    print(f"在{context}过程中发生异常: {e}")
-    traceback.print_exc()
\ No newline at end of file
+    '''通过 logging 记录异常堆栈，并可以附加上下文信息'''
+    logger.error("在%s过程中发生异常: %s", context, e, exc_info=e)